@@ -2,6 +2,7 @@ pub use sea_orm_migration::prelude::*;
 
 mod m20240408_005449_init;
 mod m20240508_214652_create_files_cache;
+mod m20261015_120000_create_tg_uses_user_index;
 
 pub struct Migrator;
 
@@ -11,6 +12,7 @@ impl MigratorTrait for Migrator {
         vec![
             Box::new(m20240408_005449_init::Migration),
             Box::new(m20240508_214652_create_files_cache::Migration),
+            Box::new(m20261015_120000_create_tg_uses_user_index::Migration),
         ]
     }
 }
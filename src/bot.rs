@@ -26,7 +26,7 @@ use crate::{
     storage::Storage,
 };
 
-pub async fn run_bot(db: Storage, bot: Bot) -> Result<()> {
+pub async fn run_bot(db: Storage, bot: Bot, admin_chat_id: ChatId) -> Result<()> {
     let handler = dptree::entry()
         .branch(Update::filter_message().endpoint(handle_message))
         .branch(Update::filter_callback_query().endpoint(handle_callback_query))
@@ -39,10 +39,17 @@ pub async fn run_bot(db: Storage, bot: Bot) -> Result<()> {
     let states = StateStorage::default();
 
     let mut dispatcher = Dispatcher::builder(bot.clone(), handler)
-        .dependencies(dptree::deps![db.clone(), states])
-        .enable_ctrlc_handler()
+        .dependencies(dptree::deps![db.clone(), states, admin_chat_id])
         .build();
 
+    let shutdown_token = dispatcher.shutdown_token();
+    tokio::spawn(async move {
+        crate::shutdown_signal().await;
+        if let Ok(shutdown) = shutdown_token.shutdown() {
+            shutdown.await;
+        }
+    });
+
     dispatcher.dispatch().await;
 
     Ok(())
@@ -138,8 +145,13 @@ fn try_set_file_from_msg(msg: &Message, meme: &mut memes::ActiveModel) -> Result
     }
 }
 
-async fn handle_message(bot: Bot, msg: Message, db: Storage, states: StateStorage) -> Result<()> {
-    let admin_chat_id: i64 = std::env::var("ADMIN_CHANNEL_ID")?.parse()?;
+async fn handle_message(
+    bot: Bot,
+    msg: Message,
+    db: Storage,
+    states: StateStorage,
+    admin_chat_id: ChatId,
+) -> Result<()> {
     let user = msg.from().context("no from")?.id;
     let state = states
         .lock()
@@ -149,7 +161,7 @@ async fn handle_message(bot: Bot, msg: Message, db: Storage, states: StateStorag
         .unwrap_or_default();
 
     if bot
-        .get_chat_member(ChatId(admin_chat_id), msg.from().context("no from")?.id)
+        .get_chat_member(admin_chat_id, msg.from().context("no from")?.id)
         .await?
         .is_present()
     {
@@ -171,7 +183,10 @@ async fn handle_message(bot: Bot, msg: Message, db: Storage, states: StateStorag
                     if let Some(meme) = db.meme_by_tg_unique_id(&file.unique_id).await? {
                         bot.send_message(
                             msg.chat.id,
-                            format!("https://t.me/c/{admin_chat_id}/{}", meme.control_message_id),
+                            format!(
+                                "https://t.me/c/{}/{}",
+                                admin_chat_id.0, meme.control_message_id
+                            ),
                         )
                         .await?;
                     } else {
@@ -396,8 +411,7 @@ async fn handle_inline_query(bot: Bot, query: InlineQuery, db: Storage) -> Resul
 }
 
 async fn handle_chosen_inline_result(chosen: ChosenInlineResult, db: Storage) -> Result<()> {
-    let splitten = chosen.result_id.split(':').collect_vec();
-    let [use_id, meme_source, meme_id] = splitten[..] else {
+    let Some((use_id, meme_source, meme_id)) = chosen.result_id.split(':').collect_tuple() else {
         bail!("invalid id")
     };
     db.save_tg_chosen(
@@ -79,10 +79,9 @@ impl FromStr for MemeEditCallback {
     type Err = anyhow::Error;
 
     fn from_str(s: &str) -> Result<Self> {
-        let mut chars = s.chars();
-        let action = MemeEditAction::from_char(chars.next().context("no chars")?)?;
-        let language: String = chars.clone().take(2).collect();
-        let meme_id = chars.skip(2).collect::<String>().parse()?;
+        let action = MemeEditAction::from_char(s.chars().next().context("no chars")?)?;
+        let language = s.get(1..3).context("no language")?.to_owned();
+        let meme_id = s.get(3..).context("no meme id")?.parse()?;
         Ok(Self {
             action,
             meme_id,
@@ -245,14 +244,13 @@ fn gen_meme_control_keyboard(
 
 pub async fn refresh_meme_control_msg(
     bot: &Bot,
+    chat_id: ChatId,
     meme: &memes::Model,
     translations: &[translations::Model],
 ) -> Result<Option<Message>> {
     let text = gen_meme_control_text(meme, translations);
     let keyboard = gen_meme_control_keyboard(meme, translations);
 
-    let chat_id: i64 = std::env::var("ADMIN_CHANNEL_ID")?.parse()?;
-    let chat_id = ChatId(chat_id);
     let input_file = InputFile::file_id(meme.tg_id.clone());
 
     Ok(if meme.control_message_id == -1 {
@@ -1,5 +1,6 @@
 #![feature(let_chains)]
 
+use std::io::IsTerminal;
 use std::str::FromStr;
 use std::sync::Arc;
 
@@ -20,12 +21,14 @@ fn main() -> Result<()> {
 
     tracing_subscriber::registry()
         .with(
-            tracing_subscriber::fmt::layer().with_filter(
-                tracing_subscriber::filter::LevelFilter::from_str(
-                    &std::env::var("RUST_LOG").unwrap_or_else(|_| String::from("info")),
-                )
-                .unwrap_or(tracing_subscriber::filter::LevelFilter::INFO),
-            ),
+            tracing_subscriber::fmt::layer()
+                .with_ansi(std::io::stdout().is_terminal())
+                .with_filter(
+                    tracing_subscriber::filter::LevelFilter::from_str(
+                        &std::env::var("RUST_LOG").unwrap_or_else(|_| String::from("info")),
+                    )
+                    .unwrap_or(tracing_subscriber::filter::LevelFilter::INFO),
+                ),
         )
         .with(
             sentry::integrations::tracing::layer().event_filter(|md| match *md.level() {
@@ -66,15 +69,27 @@ fn main() -> Result<()> {
 
 async fn _main() -> Result<()> {
     let bot = teloxide::Bot::from_env();
+    let admin_chat_id = teloxide::types::ChatId(std::env::var("ADMIN_CHANNEL_ID")?.parse()?);
     let yandex = Arc::new(yandex::Yandex::new()?);
-    let db = Storage::new(bot.clone(), yandex).await?;
+    let db = Storage::new(bot.clone(), yandex, admin_chat_id).await?;
 
     let (bot_res, web_res) = tokio::join!(
-        bot::run_bot(db.clone(), bot.clone()),
-        web::run_webserver(db)
+        bot::run_bot(db.clone(), bot.clone(), admin_chat_id),
+        web::run_webserver(db.clone())
     );
+    db.close().await;
     bot_res?;
     web_res?;
 
     Ok(())
 }
+
+/// Resolves on Ctrl-C or on SIGTERM, which systemd and docker send to stop the service.
+async fn shutdown_signal() {
+    let mut terminate = tokio::signal::unix::signal(tokio::signal::unix::SignalKind::terminate())
+        .expect("can't install SIGTERM handler");
+    tokio::select! {
+        _ = tokio::signal::ctrl_c() => {}
+        _ = terminate.recv() => {}
+    }
+}
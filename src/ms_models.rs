@@ -3,10 +3,10 @@ use std::collections::HashMap;
 use serde::{Deserialize, Serialize};
 
 #[derive(Serialize)]
-pub struct MsMeme {
+pub struct MsMeme<'a> {
     pub id: i32,
-    pub text: Option<String>,
-    pub translations: HashMap<String, MsMemeTranslation>,
+    pub text: Option<&'a str>,
+    pub translations: HashMap<&'a str, MsMemeTranslation<'a>>,
 }
 
 #[derive(Debug, Deserialize)]
@@ -15,8 +15,8 @@ pub struct MsMemeResult {
 }
 
 #[derive(Serialize)]
-pub struct MsMemeTranslation {
-    pub title: String,
-    pub caption: String,
-    pub description: String,
+pub struct MsMemeTranslation<'a> {
+    pub title: &'a str,
+    pub caption: &'a str,
+    pub description: &'a str,
 }
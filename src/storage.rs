@@ -1,7 +1,10 @@
+use std::collections::{HashMap, VecDeque};
 use std::fmt::Write;
-use std::sync::Arc;
+use std::sync::{Arc, Mutex};
+use std::time::Duration;
 
 use anyhow::{Context, Result};
+use bytes::Bytes;
 use chrono::Utc;
 use entities::{
     files_cache, memes,
@@ -10,8 +13,8 @@ use entities::{
     slug_redirects, tg_uses, translations, web_visits,
 };
 use itertools::Itertools;
-use meilisearch_sdk::client::Client;
-use migration::{Migrator, MigratorTrait, OnConflict};
+use meilisearch_sdk::{client::Client, indexes::Index, search::Selectors};
+use migration::{Expr, Migrator, MigratorTrait, OnConflict};
 use qdrant_client::{
     client::{Payload, QdrantClient},
     qdrant::{
@@ -21,11 +24,17 @@ use qdrant_client::{
     },
 };
 use sea_orm::{
-    prelude::*, ActiveValue, ConnectOptions, Database, IntoActiveModel, QueryOrder, QuerySelect,
-    TransactionTrait,
+    prelude::*, ActiveValue, ConnectOptions, Database, FromQueryResult, IntoActiveModel,
+    QueryOrder, QuerySelect, TransactionTrait,
 };
-use teloxide::{net::Download, requests::Requester, types::Message, Bot};
-use tracing::log::LevelFilter;
+use teloxide::{
+    net::Download,
+    requests::Requester,
+    types::{ChatId, Message},
+    Bot,
+};
+use tokio::{sync::mpsc, task::JoinHandle};
+use tracing::{error, info, log::LevelFilter, warn};
 
 use crate::{
     control::refresh_meme_control_msg,
@@ -33,29 +42,119 @@ use crate::{
     yandex::Yandex,
 };
 
+/// Maximum number of web visits written by a single INSERT.
+const WEB_VISITS_BATCH_SIZE: usize = 256;
+
+/// How long shutdown waits for queued web visits to be written.
+const WEB_VISITS_FLUSH_TIMEOUT: Duration = Duration::from_secs(10);
+
+/// Number of distinct search queries whose embeddings are kept in memory.
+const QUERY_EMBEDDINGS_CACHE_SIZE: usize = 4096;
+
+/// Upper bound for the total size of files kept in memory.
+const MEMORY_FILES_CACHE_SIZE: usize = 64 * 1024 * 1024;
+
+/// Recently served Telegram files, evicted in insertion order once
+/// [`MEMORY_FILES_CACHE_SIZE`] is exceeded.
+#[derive(Default)]
+struct MemoryFilesCache {
+    files: HashMap<String, Bytes>,
+    order: VecDeque<String>,
+    size: usize,
+}
+
+impl MemoryFilesCache {
+    fn get(&self, id: &str) -> Option<Bytes> {
+        self.files.get(id).cloned()
+    }
+
+    fn insert(&mut self, id: String, data: Bytes) {
+        if data.len() > MEMORY_FILES_CACHE_SIZE || self.files.contains_key(&id) {
+            return;
+        }
+
+        while self.size + data.len() > MEMORY_FILES_CACHE_SIZE {
+            let Some(evicted) = self.order.pop_front() else {
+                break;
+            };
+            if let Some(evicted) = self.files.remove(&evicted) {
+                self.size -= evicted.len();
+            }
+        }
+
+        self.size += data.len();
+        self.order.push_back(id.clone());
+        self.files.insert(id, data);
+    }
+}
+
+type FilesLoading = Mutex<HashMap<String, Arc<tokio::sync::Mutex<()>>>>;
+
+/// Removes a file's loading lock from [`Storage::files_loading`] however the load ends,
+/// including errors and cancellation of the request that started it.
+struct FileLoadingGuard<'a> {
+    files_loading: &'a FilesLoading,
+    id: &'a str,
+    lock: Arc<tokio::sync::Mutex<()>>,
+}
+
+impl Drop for FileLoadingGuard<'_> {
+    fn drop(&mut self) {
+        let mut files_loading = self.files_loading.lock().unwrap();
+        // A newer loader may have registered its own lock after ours was removed.
+        if files_loading
+            .get(self.id)
+            .is_some_and(|lock| Arc::ptr_eq(lock, &self.lock))
+        {
+            files_loading.remove(self.id);
+        }
+    }
+}
+
+/// Fields of a meme needed to answer an inline query.
+#[derive(FromQueryResult)]
+pub struct FoundMeme {
+    pub id: i32,
+    pub slug: String,
+    pub media_type: MediaType,
+    pub tg_id: String,
+}
+
 #[derive(Clone)]
 pub struct Storage {
     dc: DatabaseConnection,
-    ms: Client,
+    ms: Index,
     qd: Arc<QdrantClient>,
     bot: Bot,
+    admin_chat_id: ChatId,
     yandex: Arc<Yandex>,
+    files: Arc<Mutex<MemoryFilesCache>>,
+    files_loading: Arc<FilesLoading>,
+    query_embeddings: Arc<Mutex<HashMap<String, Vec<f32>>>>,
+    web_visits: mpsc::Sender<web_visits::ActiveModel>,
+    web_visits_writer: Arc<Mutex<Option<JoinHandle<()>>>>,
 }
 
 impl Storage {
-    pub async fn new(bot: Bot, yandex: Arc<Yandex>) -> Result<Self> {
+    pub async fn new(bot: Bot, yandex: Arc<Yandex>, admin_chat_id: ChatId) -> Result<Self> {
         let db_url = std::env::var("DATABASE_URL")?;
 
         let mut conn_options = ConnectOptions::new(db_url);
+        conn_options.max_connections(32);
+        conn_options.min_connections(4);
         conn_options.sqlx_logging_level(LevelFilter::Debug);
         conn_options.sqlx_logging(true);
 
         let dc = Database::connect(conn_options).await?;
         Migrator::up(&dc, None).await?;
 
-        let ms = Client::new("http://127.0.0.1:7700", None::<String>)?;
+        let ms = Client::new("http://127.0.0.1:7700", None::<String>)?.index("memexpert");
 
-        let qd = Arc::new(QdrantClient::from_url("http://127.0.0.1:6334").build()?);
+        let qd = Arc::new(
+            QdrantClient::from_url("http://127.0.0.1:6334")
+                .keep_alive_while_idle()
+                .build()?,
+        );
         if !qd.collection_exists("memexpert-text").await? {
             qd.create_collection(&CreateCollection {
                 collection_name: "memexpert-text".to_owned(),
@@ -71,12 +170,27 @@ impl Storage {
             .await?;
         }
 
+        let (web_visits, web_visits_rx) = mpsc::channel(WEB_VISITS_BATCH_SIZE * 16);
+        let web_visits_writer = tokio::spawn(save_web_visits(dc.clone(), web_visits_rx));
+        // Report a writer that died instead of leaving every later visit to fail quietly.
+        let web_visits_writer = tokio::spawn(async move {
+            if let Err(e) = web_visits_writer.await {
+                error!("web visits writer failed: {e:?}");
+            }
+        });
+
         Ok(Self {
             dc,
             ms,
             qd,
             bot,
+            admin_chat_id,
             yandex,
+            files: Arc::default(),
+            files_loading: Arc::default(),
+            query_embeddings: Arc::default(),
+            web_visits,
+            web_visits_writer: Arc::new(Mutex::new(Some(web_visits_writer))),
         })
     }
 
@@ -88,27 +202,24 @@ impl Storage {
         if meme.publish_status == PublishStatus::Published {
             let meme = MsMeme {
                 id: meme.id,
-                text: meme.text.clone(),
+                text: meme.text.as_deref(),
                 translations: translations
                     .iter()
                     .map(|t| {
                         (
-                            t.language.clone(),
+                            t.language.as_str(),
                             MsMemeTranslation {
-                                title: t.title.clone(),
-                                caption: t.caption.clone(),
-                                description: t.description.clone(),
+                                title: &t.title,
+                                caption: &t.caption,
+                                description: &t.description,
                             },
                         )
                     })
                     .collect(),
             };
-            self.ms
-                .index("memexpert")
-                .add_or_replace(&[meme], Some("id"))
-                .await?;
+            self.ms.add_or_replace(&[meme], Some("id")).await?;
         } else {
-            self.ms.index("memexpert").delete_document(meme.id).await?;
+            self.ms.delete_document(meme.id).await?;
         }
 
         Ok(())
@@ -192,7 +303,7 @@ impl Storage {
             )?;
         }
 
-        self.yandex.text_embedding(text, "text-search-doc").await
+        self.yandex.text_embedding(&text, "text-search-doc").await
     }
 
     async fn process_meme_update(
@@ -209,7 +320,17 @@ impl Storage {
             .next()
             .context("meme not found")?;
 
-        let control_msg = refresh_meme_control_msg(&self.bot, &meme, &translations).await?;
+        self.process_meme_models(trans, &meme, &translations).await
+    }
+
+    async fn process_meme_models(
+        &self,
+        trans: &impl ConnectionTrait,
+        meme: &memes::Model,
+        translations: &[translations::Model],
+    ) -> Result<Option<Message>> {
+        let control_msg =
+            refresh_meme_control_msg(&self.bot, self.admin_chat_id, meme, translations).await?;
 
         if let Some(control_msg) = &control_msg {
             memes::ActiveModel {
@@ -221,15 +342,12 @@ impl Storage {
             .await?;
         }
 
-        self.create_or_replace_meme_in_ms(&meme, &translations)
-            .await?;
-        self.create_or_replace_meme_in_qd(&meme, &translations)
-            .await?;
-
-        self.load_tg_file(&meme.tg_id, meme.content_length.try_into()?)
-            .await?;
-        self.load_tg_file(&meme.thumb_tg_id, meme.thumb_content_length.try_into()?)
-            .await?;
+        tokio::try_join!(
+            self.create_or_replace_meme_in_ms(meme, translations),
+            self.create_or_replace_meme_in_qd(meme, translations),
+            self.cache_tg_file(&meme.tg_id, meme.content_length.try_into()?),
+            self.cache_tg_file(&meme.thumb_tg_id, meme.thumb_content_length.try_into()?),
+        )?;
 
         Ok(control_msg)
     }
@@ -248,10 +366,12 @@ impl Storage {
             .unwrap();
 
         translation.meme_id = ActiveValue::set(meme.id);
-        Translations::insert(translation).exec(&trans).await?;
+        let translation = Translations::insert(translation)
+            .exec_with_returning(&trans)
+            .await?;
 
         let control_msg = self
-            .process_meme_update(&trans, meme.id)
+            .process_meme_models(&trans, &meme, &[translation])
             .await?
             .context("must create control message")?;
 
@@ -259,17 +379,25 @@ impl Storage {
         Ok(control_msg)
     }
 
-    pub async fn meme_with_translations_by_slug(
+    pub async fn meme_with_translation_by_slug(
         &self,
         slug: &str,
-    ) -> Result<Option<(memes::Model, Vec<translations::Model>)>> {
+        language: &str,
+    ) -> Result<Option<(memes::Model, translations::Model)>> {
         Ok(Memes::find()
-            .find_with_related(Translations)
+            .find_also_related(Translations)
             .filter(memes::Column::Slug.eq(slug))
-            .all(&self.dc)
+            .filter(translations::Column::Language.eq(language))
+            .one(&self.dc)
             .await?
-            .into_iter()
-            .next())
+            .and_then(|(meme, translation)| Some((meme, translation?))))
+    }
+
+    pub async fn meme_by_slug(&self, slug: &str) -> Result<Option<memes::Model>> {
+        Ok(Memes::find()
+            .filter(memes::Column::Slug.eq(slug))
+            .one(&self.dc)
+            .await?)
     }
 
     pub async fn meme_by_tg_unique_id(&self, tg_unique_id: &str) -> Result<Option<memes::Model>> {
@@ -356,43 +484,45 @@ impl Storage {
         Ok(())
     }
 
-    pub async fn search_memes(
-        &self,
-        user_id: i64,
-        query: &str,
-    ) -> Result<Vec<(memes::Model, char, i64)>> {
-        let tg_use = TgUses::insert(tg_uses::ActiveModel {
-            user_id: ActiveValue::set(user_id),
-            query: ActiveValue::set(if query.is_empty() {
-                None
-            } else {
-                Some(query.to_owned())
-            }),
-            ..Default::default()
-        })
-        .exec_with_returning(&self.dc)
-        .await?;
+    async fn query_embedding(&self, query: &str) -> Result<Vec<f32>> {
+        if let Some(embedding) = self.query_embeddings.lock().unwrap().get(query) {
+            return Ok(embedding.clone());
+        }
 
-        let ids = if query.is_empty() {
+        let embedding = self
+            .yandex
+            .text_embedding(query, "text-search-query")
+            .await?;
+
+        let mut query_embeddings = self.query_embeddings.lock().unwrap();
+        if query_embeddings.len() >= QUERY_EMBEDDINGS_CACHE_SIZE {
+            query_embeddings.clear();
+        }
+        query_embeddings.insert(query.to_owned(), embedding.clone());
+
+        Ok(embedding)
+    }
+
+    async fn search_meme_ids(&self, user_id: i64, query: &str) -> Result<Vec<(i32, char)>> {
+        Ok(if query.is_empty() {
             TgUses::find()
+                .select_only()
+                .column(tg_uses::Column::ChosenMemeId)
                 .filter(tg_uses::Column::UserId.eq(user_id))
                 .filter(tg_uses::Column::ChosenMemeId.is_not_null())
                 .order_by_desc(tg_uses::Column::Id)
                 .limit(1024)
+                .into_tuple::<i32>()
                 .all(&self.dc)
                 .await?
                 .into_iter()
-                .map(|m| m.chosen_meme_id.unwrap_or(-1))
                 .unique()
                 .map(|i| (i, 'r'))
                 .collect_vec()
         } else {
             let (qd_results, ms_results): (Result<_>, _) = tokio::join!(
                 async {
-                    let query_embedding = self
-                        .yandex
-                        .text_embedding(query, "text-search-query")
-                        .await?;
+                    let query_embedding = self.query_embedding(query).await?;
                     Ok(self
                         .qd
                         .search_points(&SearchPoints {
@@ -406,10 +536,10 @@ impl Storage {
                 },
                 async {
                     self.ms
-                        .index("memexpert")
                         .search()
                         .with_query(query)
                         .with_limit(100)
+                        .with_attributes_to_retrieve(Selectors::Some(&["id"]))
                         .with_show_ranking_score(true)
                         .execute::<MsMemeResult>()
                         .await
@@ -449,36 +579,74 @@ impl Storage {
                 .map(|i| (i.0, i.2))
                 .unique_by(|i| i.0)
                 .collect_vec()
-        };
+        })
+    }
 
-        let memes = Memes::find()
+    pub async fn search_memes(
+        &self,
+        user_id: i64,
+        query: &str,
+    ) -> Result<Vec<(FoundMeme, char, i64)>> {
+        let (tg_use_id, ids): (Result<_>, _) = tokio::join!(
+            async {
+                Ok(TgUses::insert(tg_uses::ActiveModel {
+                    user_id: ActiveValue::set(user_id),
+                    query: ActiveValue::set(if query.is_empty() {
+                        None
+                    } else {
+                        Some(query.to_owned())
+                    }),
+                    ..Default::default()
+                })
+                .exec(&self.dc)
+                .await?
+                .last_insert_id)
+            },
+            self.search_meme_ids(user_id, query)
+        );
+        let (tg_use_id, ids) = (tg_use_id?, ids?);
+
+        let mut memes: HashMap<_, _> = Memes::find()
+            .select_only()
+            .columns([
+                memes::Column::Id,
+                memes::Column::Slug,
+                memes::Column::MediaType,
+                memes::Column::TgId,
+            ])
             .filter(memes::Column::Id.is_in(ids.iter().map(|i| i.0)))
             .filter(memes::Column::PublishStatus.eq(PublishStatus::Published))
-            .order_by_asc(memes::Column::Id)
+            .into_model::<FoundMeme>()
             .all(&self.dc)
-            .await?;
+            .await?
+            .into_iter()
+            .map(|m| (m.id, m))
+            .collect();
         let memes = ids
             .into_iter()
-            .filter_map(|i| {
-                if let Ok(idx) = memes.binary_search_by_key(&i.0, |m| m.id) {
-                    Some((memes[idx].clone(), i.1, tg_use.id))
-                } else {
-                    None
-                }
-            })
+            .filter_map(|i| memes.remove(&i.0).map(|m| (m, i.1, tg_use_id)))
             .take(50)
             .collect();
         Ok(memes)
     }
 
-    pub async fn all_memes_with_translations(
-        &self,
-    ) -> Result<Vec<(memes::Model, Vec<translations::Model>)>> {
-        let memes = Memes::find()
-            .find_with_related(Translations)
+    /// Returns slug, last edition time and translation languages of every meme that has
+    /// at least one translation.
+    pub async fn memes_languages(&self) -> Result<Vec<(String, DateTime, Vec<String>)>> {
+        Ok(Memes::find()
+            .select_only()
+            .column(memes::Column::Slug)
+            .column(memes::Column::LastEditionTime)
+            .column_as(
+                Expr::cust("array_agg(translations.language::text ORDER BY translations.language)"),
+                "languages",
+            )
+            .inner_join(Translations)
+            .group_by(memes::Column::Id)
+            .order_by_asc(memes::Column::Id)
+            .into_tuple()
             .all(&self.dc)
-            .await?;
-        Ok(memes)
+            .await?)
     }
 
     pub async fn save_tg_chosen(
@@ -500,25 +668,115 @@ impl Storage {
         Ok(())
     }
 
-    pub async fn create_web_visit(&self, visit: web_visits::ActiveModel) -> Result<()> {
-        WebVisits::insert(visit).exec(&self.dc).await?;
+    /// Waits until all queued web visits are written, for at most [`WEB_VISITS_FLUSH_TIMEOUT`].
+    ///
+    /// Should be called on the last handle to the storage, otherwise the queue never closes
+    /// and only the timeout ends the wait.
+    pub async fn close(self) {
+        let writer = self.web_visits_writer.lock().unwrap().take();
+        drop(self);
+        if let Some(writer) = writer
+            && tokio::time::timeout(WEB_VISITS_FLUSH_TIMEOUT, writer)
+                .await
+                .is_err()
+        {
+            warn!("timed out waiting for queued web visits to be written");
+        }
+    }
+
+    /// Queues a visit to be written together with other pending visits.
+    pub fn create_web_visit(&self, visit: web_visits::ActiveModel) -> Result<()> {
+        self.web_visits.try_send(visit)?;
         Ok(())
     }
 
-    pub async fn load_tg_file(&self, id: &str, size: usize) -> Result<Vec<u8>> {
-        if let Some(cached) = FilesCache::find_by_id(id).one(&self.dc).await? {
-            Ok(cached.data)
+    pub async fn load_tg_file(&self, id: &str, size: usize) -> Result<Bytes> {
+        if let Some(cached) = self.files.lock().unwrap().get(id) {
+            return Ok(cached);
+        }
+
+        // Concurrent requests for the same file wait for the first one instead of loading it too.
+        let loading = self
+            .files_loading
+            .lock()
+            .unwrap()
+            .entry(id.to_owned())
+            .or_default()
+            .clone();
+        let _loading = loading.lock().await;
+        let _loading_guard = FileLoadingGuard {
+            files_loading: &self.files_loading,
+            id,
+            lock: loading.clone(),
+        };
+        if let Some(cached) = self.files.lock().unwrap().get(id) {
+            return Ok(cached);
+        }
+
+        let data = if let Some(cached) = FilesCache::find_by_id(id).one(&self.dc).await? {
+            cached.data
         } else {
-            let mut dst = Vec::with_capacity(size);
-            let file = self.bot.get_file(id).await?;
-            self.bot.download_file(&file.path, &mut dst).await?;
-            files_cache::ActiveModel {
-                id: ActiveValue::set(id.to_owned()),
-                data: ActiveValue::set(dst.clone()),
-            }
-            .insert(&self.dc)
-            .await?;
-            Ok(dst)
+            let data = self.download_tg_file(id, size).await?;
+            self.save_tg_file(id, data.clone()).await?;
+            data
+        };
+
+        let data = Bytes::from(data);
+        self.files
+            .lock()
+            .unwrap()
+            .insert(id.to_owned(), data.clone());
+        Ok(data)
+    }
+
+    /// Makes sure the file is in the database cache without reading it back.
+    async fn cache_tg_file(&self, id: &str, size: usize) -> Result<()> {
+        let cached = FilesCache::find_by_id(id)
+            .select_only()
+            .column(files_cache::Column::Id)
+            .into_tuple::<String>()
+            .one(&self.dc)
+            .await?
+            .is_some();
+        if !cached {
+            let data = self.download_tg_file(id, size).await?;
+            self.save_tg_file(id, data).await?;
+        }
+        Ok(())
+    }
+
+    async fn download_tg_file(&self, id: &str, size: usize) -> Result<Vec<u8>> {
+        let mut dst = Vec::with_capacity(size);
+        let file = self.bot.get_file(id).await?;
+        self.bot.download_file(&file.path, &mut dst).await?;
+        Ok(dst)
+    }
+
+    async fn save_tg_file(&self, id: &str, data: Vec<u8>) -> Result<()> {
+        FilesCache::insert(files_cache::ActiveModel {
+            id: ActiveValue::set(id.to_owned()),
+            data: ActiveValue::set(data),
+        })
+        .on_conflict(
+            OnConflict::column(files_cache::Column::Id)
+                .do_nothing()
+                .to_owned(),
+        )
+        .exec_without_returning(&self.dc)
+        .await?;
+        Ok(())
+    }
+}
+
+async fn save_web_visits(dc: DatabaseConnection, mut rx: mpsc::Receiver<web_visits::ActiveModel>) {
+    let mut visits = Vec::with_capacity(WEB_VISITS_BATCH_SIZE);
+    while rx.recv_many(&mut visits, WEB_VISITS_BATCH_SIZE).await > 0 {
+        if let Err(e) = WebVisits::insert_many(visits.drain(..))
+            .exec_without_returning(&dc)
+            .await
+        {
+            warn!("can't save web visits: {e:?}");
         }
     }
+    info!("web visits writer stopped");
 }
@@ -20,17 +20,21 @@ use axum_extra::{
     TypedHeader,
 };
 use axum_range::{KnownSize, Ranged};
-use chrono::SecondsFormat;
+use chrono::{SecondsFormat, Utc};
 use entities::{sea_orm_active_enums::MediaType, web_visits};
 use include_dir::{include_dir, Dir};
 use itertools::Itertools;
 use rand::{distributions::Alphanumeric, Rng};
 use sea_orm::ActiveValue;
+use tracing::warn;
 
 use crate::storage::Storage;
 
 static ASSETS_DIR: Dir<'_> = include_dir!("$CARGO_MANIFEST_DIR/assets");
 
+/// Sent with meme files and with 304 responses for them.
+const FILE_CACHE_CONTROL: &str = "max-age=604800";
+
 pub async fn run_webserver(db: Storage) -> Result<()> {
     let app = Router::new()
         .route("/:path", get(assets))
@@ -42,7 +46,9 @@ pub async fn run_webserver(db: Storage) -> Result<()> {
         .with_state(AppState { db });
 
     let listener = tokio::net::TcpListener::bind("0.0.0.0:3000").await.unwrap();
-    axum::serve(listener, app).await?;
+    axum::serve(listener, app)
+        .with_graceful_shutdown(crate::shutdown_signal())
+        .await?;
     Ok(())
 }
 
@@ -52,21 +58,18 @@ struct AppState {
 }
 
 async fn sitemap_xml(State(state): State<AppState>) -> Result<Response, AppError> {
-    let memes = state.db.all_memes_with_translations().await?;
+    let memes = state.db.memes_languages().await?;
 
     let memes: Vec<_> = memes
         .into_iter()
-        .map(|(m, trs)| SitemapMeme {
-            slug: m.slug,
-            lastmod: m
-                .last_edition_time
+        .map(|(slug, last_edition_time, languages)| SitemapMeme {
+            slug,
+            lastmod: last_edition_time
                 .and_utc()
                 .to_rfc3339_opts(SecondsFormat::Secs, false),
-            translations: trs
+            translations: languages
                 .into_iter()
-                .map(|tr| SitemapTranslation {
-                    language: tr.language,
-                })
+                .map(|language| SitemapTranslation { language })
                 .collect(),
         })
         .collect();
@@ -79,15 +82,11 @@ async fn sitemap_xml(State(state): State<AppState>) -> Result<Response, AppError
 }
 
 async fn sitemap_txt(State(state): State<AppState>) -> Result<Response, AppError> {
-    let memes = state.db.all_memes_with_translations().await?;
+    let memes = state.db.memes_languages().await?;
     let mut sitemap = String::new();
-    for (meme, translations) in memes {
-        for translation in translations {
-            writeln!(
-                &mut sitemap,
-                "https://memexpert.xyz/{}/{}",
-                translation.language, meme.slug
-            )?;
+    for (slug, _, languages) in memes {
+        for language in languages {
+            writeln!(&mut sitemap, "https://memexpert.xyz/{language}/{slug}")?;
         }
     }
     Ok((
@@ -124,12 +123,13 @@ async fn assets(Path(path): Path<String>) -> impl IntoResponse {
 async fn file(
     State(state): State<AppState>,
     Path(filename): Path<String>,
+    headers: HeaderMap,
     range: Option<TypedHeader<Range>>,
 ) -> Result<Response, AppError> {
     let splitten = filename.split('.').collect_vec();
     let slug = splitten[0];
 
-    let Some((meme, _)) = state.db.meme_with_translations_by_slug(slug).await? else {
+    let Some(meme) = state.db.meme_by_slug(slug).await? else {
         return Ok((StatusCode::NOT_FOUND, "meme not found").into_response());
     };
 
@@ -139,6 +139,22 @@ async fn file(
         (meme.tg_id, meme.content_length)
     };
 
+    // The stored file id only changes when the meme file is replaced, so it is a strong validator.
+    let etag = format!("\"{tg_id}\"");
+    if let Some(if_none_match) = headers.get(header::IF_NONE_MATCH)
+        && let Ok(if_none_match) = if_none_match.to_str()
+        && (if_none_match.trim() == "*"
+            || if_none_match
+                .split(',')
+                .any(|tag| tag.trim().trim_start_matches("W/") == etag))
+    {
+        let headers = [
+            (header::CACHE_CONTROL, FILE_CACHE_CONTROL),
+            (header::ETAG, &etag),
+        ];
+        return Ok((StatusCode::NOT_MODIFIED, headers).into_response());
+    }
+
     let file = state
         .db
         .load_tg_file(&tg_id, content_length.try_into()?)
@@ -147,7 +163,8 @@ async fn file(
     let range = range.map(|TypedHeader(range)| range);
 
     let headers = [
-        (header::CACHE_CONTROL, "max-age=604800"),
+        (header::CACHE_CONTROL, FILE_CACHE_CONTROL),
+        (header::ETAG, &etag),
         (header::CONTENT_TYPE, &meme.mime_type),
         (
             header::CONTENT_DISPOSITION,
@@ -174,22 +191,22 @@ async fn meme(
     headers: HeaderMap,
     jar: CookieJar,
 ) -> Result<Response, AppError> {
-    if let Some((meme, translations)) = state.db.meme_with_translations_by_slug(&slug).await?
-        && let Some(translation) = translations.into_iter().find(|tr| tr.language == language)
+    if let Some((meme, translation)) = state
+        .db
+        .meme_with_translation_by_slug(&slug, &language)
+        .await?
     {
-        let mime_type: mime::Mime = meme.mime_type.parse()?;
         let locale = match language.as_str() {
             "en" => "en_US",
             "ru" => "ru_RU",
             _ => return Err(anyhow!("unknown language").into()),
         }
         .to_owned();
-        let extension = match mime_type.subtype() {
-            mime::JPEG => "jpg",
-            mime::MP4 => "mp4",
+        let (extension, is_mime_video) = match meme.mime_type.as_str() {
+            "image/jpeg" => ("jpg", false),
+            "video/mp4" => ("mp4", true),
             _ => return Err(anyhow!("unknown mime").into()),
-        }
-        .to_owned();
+        };
 
         let uid = if let Some(uid) = jar.get("uid")
             && uid.value().len() == 8
@@ -208,7 +225,10 @@ async fn meme(
         uid_cookie.set_same_site(SameSite::Strict);
         uid_cookie.set_secure(true);
 
+        // Visits are written with multi-row INSERTs, which require every visit to set the same
+        // columns. The timestamp is taken here because the INSERT may run later.
         let visit = web_visits::ActiveModel {
+            timestamp: ActiveValue::set(Utc::now().naive_utc()),
             user_id: ActiveValue::set(uid),
             meme_id: ActiveValue::set(meme.id),
             language: ActiveValue::set(language.clone()),
@@ -221,7 +241,9 @@ async fn meme(
 
             ..Default::default()
         };
-        state.db.create_web_visit(visit).await?;
+        if let Err(e) = state.db.create_web_visit(visit) {
+            warn!("can't save web visit: {e:?}");
+        }
 
         let headers = [(header::CONTENT_LANGUAGE, translation.language)];
 
@@ -239,9 +261,9 @@ async fn meme(
                 text: meme.text,
                 caption: translation.caption,
                 description: translation.description,
-                mime_type: mime_type.to_string(),
+                mime_type: meme.mime_type,
                 thumb_mime_type: meme.thumb_mime_type,
-                is_mime_video: mime_type.type_() == mime::VIDEO,
+                is_mime_video,
                 is_animation: meme.media_type == MediaType::Animation,
                 duration: chrono::Duration::seconds(meme.duration.into()).to_string(),
                 duration_secs: meme.duration,
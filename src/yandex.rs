@@ -1,34 +1,41 @@
-use std::env;
+use std::{env, time::Duration};
 
 use anyhow::Result;
-use reqwest::Client;
+use reqwest::{
+    header::{HeaderMap, HeaderValue, AUTHORIZATION},
+    Client,
+};
 use serde::{Deserialize, Serialize};
 
 pub struct Yandex {
-    ycl_api_key: String,
     ycl_folder: String,
     client: Client,
 }
 
 impl Yandex {
     pub fn new() -> Result<Self> {
+        let mut authorization =
+            HeaderValue::from_str(&format!("Api-Key {}", env::var("YCL_API_KEY")?))?;
+        authorization.set_sensitive(true);
+
         Ok(Self {
-            ycl_api_key: env::var("YCL_API_KEY")?,
             ycl_folder: env::var("YCL_FOLDER")?,
-            client: Client::new(),
+            client: Client::builder()
+                .default_headers(HeaderMap::from_iter([(AUTHORIZATION, authorization)]))
+                .pool_idle_timeout(Duration::from_secs(300))
+                .tcp_keepalive(Duration::from_secs(60))
+                .http2_keep_alive_interval(Duration::from_secs(30))
+                .http2_keep_alive_while_idle(true)
+                .build()?,
         })
     }
 
-    pub async fn text_embedding(
-        &self,
-        text: impl Into<String>,
-        model_type: &str,
-    ) -> Result<Vec<f32>> {
+    pub async fn text_embedding(&self, text: &str, model_type: &str) -> Result<Vec<f32>> {
         #[derive(Serialize)]
         #[serde(rename_all = "camelCase")]
-        struct EmbeddingRequest {
-            model_uri: String,
-            text: String,
+        struct EmbeddingRequest<'a> {
+            model_uri: &'a str,
+            text: &'a str,
         }
 
         #[derive(Deserialize)]
@@ -41,10 +48,9 @@ impl Yandex {
         let res: EmbeddingResponse = self
             .client
             .post("https://llm.api.cloud.yandex.net/foundationModels/v1/textEmbedding")
-            .header("Authorization", format!("Api-Key {}", self.ycl_api_key))
             .json(&EmbeddingRequest {
-                text: text.into(),
-                model_uri,
+                text,
+                model_uri: &model_uri,
             })
             .send()
             .await?